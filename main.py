@@ -1,6 +1,8 @@
 import os
 import sys
 import asyncio
+import heapq
+import inspect
 import ccxt.async_support as ccxt
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
@@ -8,9 +10,16 @@ from telegram.error import Conflict
 from dotenv import load_dotenv
 import logging
 import time
+import struct
+from collections import deque
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from multiprocessing import shared_memory, resource_tracker
 from binance.client import Client as BinanceClient
+from binance.exceptions import BinanceAPIException
 from pybit.unified_trading import HTTP as BybitClient
+from pybit.exceptions import InvalidRequestError
 
 # Fix for aiodns on Windows
 if sys.platform == "win32":
@@ -29,6 +38,7 @@ user_data = {}
 
 # Supported exchanges
 EXCHANGES = ["binance", "bybit", "kucoin", "kraken", "bingx", "okx"]
+EXCHANGE_INDEX = {ex_id: i for i, ex_id in enumerate(EXCHANGES)}
 
 # Default trading fees
 DEFAULT_FEES = {
@@ -40,6 +50,40 @@ DEFAULT_FEES = {
     'kucoin': 0.1,
 }
 
+# Account trading fees per user:
+# {user_id: {"loaded_at": ts, "fees": {exchange: {symbol: pct}}, "tokens": {exchange: set}, "pending": task}}
+# Each exchange table has a "default" entry used for symbols without a specific rate;
+# "tokens" are the symbols already looked up on venues that only report fees per symbol,
+# and "pending" is the background task looking up the rest.
+fee_cache = {}
+FEE_CACHE_TTL = 3600  # seconds
+FEE_BATCH_SIZE = 50  # Kraken pairs per TradeVolume request
+
+# Quotes older than this (by exchange time, else receive time) are ignored by the analyzer
+QUOTE_MAX_AGE = float(os.getenv("QUOTE_MAX_AGE", "10"))  # seconds
+
+# Exchange health: rolling latency/error tracking per exchange endpoint
+HEALTH_WINDOW = 100  # samples kept per endpoint
+BREAKER_MIN_SAMPLES = 10
+BREAKER_ERROR_RATE = 0.5  # open the circuit when this share of recent calls failed
+BREAKER_COOLDOWN = 60  # seconds a venue is skipped once its circuit opens
+MIN_TIMEOUT = 1.0
+MAX_TIMEOUT = 10.0
+MIN_HEDGE_DELAY = 0.2  # seconds before a hedged read sends its duplicate request
+EXCHANGE_WORKERS = 4  # threads per exchange for blocking (SDK/REST) market data requests
+
+# Execution scheduler
+ORDER_BOOK_DEPTH = 20  # levels per side used for order routing
+MIN_TRADE_AMOUNT = 10  # USDT; smaller allocations are dropped
+EXCHANGE_CONCURRENCY = {
+    'binance': 3,
+    'bybit': 3,
+    'kucoin': 2,
+    'kraken': 1,
+    'bingx': 2,
+    'okx': 2,
+}
+
 # API Clients (placeholders; updated with user keys)
 binance = None
 bybit = None
@@ -49,6 +93,20 @@ ccxt_exchanges = {
     'kraken': ccxt.kraken({'enableRateLimit': True}),
     'okx': ccxt.okx({'enableRateLimit': True}),
 }
+# Venues whose market data comes from ccxt; the others use their native SDK or REST endpoints
+CCXT_MARKET_DATA = ['bingx', 'kucoin']
+
+# Market data feed: one process owns the exchange connections and publishes
+# prices into a shared memory ring buffer that bot workers read from.
+FEED_SHM_NAME = os.getenv("MARKET_DATA_SHM", "arb_market_data")
+FEED_SLOTS = 16384
+FEED_INTERVAL = 5  # seconds between price sweeps
+FEED_TOKEN_REFRESH = 600  # seconds between token list reloads
+FEED_STALE_AFTER = 60  # ignore the feed if it has not published for this long
+FEED_HEADER = struct.Struct('<QQd')  # last sequence, slot count, last publish time
+# sequence, token, exchange index, bid, ask, bid size, ask size, exchange time, receive time
+FEED_RECORD = struct.Struct('<Q24sBdddddd')
+FEED_SEQ = struct.Struct('<Q')
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -73,6 +131,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/start - Show this message\n"
         "/setkeys <exchange> - Set API keys\n"
         "/scan - Find arbitrage opportunities\n"
+        "/execute <budget> - Trade the last scan's opportunities concurrently\n"
         "/getip - Check your IP for whitelisting\n"
         "/help - Get help information\n\n"
         "Currently monitoring:\n"
@@ -128,6 +187,8 @@ async def handle_keys(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "passphrase": passphrase
         }
         logger.info(f"Keys saved for user {user_id}, exchange {exchange}: {user_data[user_id][exchange]}")
+        # Fees depend on the account, so reload them with the new keys
+        fee_cache.pop(user_id, None)
         await update.message.reply_text(f"{exchange.capitalize()} API keys saved!")
     except Exception as e:
         logger.error(f"Error processing keys for user {user_id}, exchange {exchange}: {str(e)}")
@@ -190,21 +251,25 @@ def fetch_bybit_tokens():
         return []
 
 
+def fetch_kraken_pairs() -> dict:
+    """Map Kraken pair names (as used in Ticker responses) to BASE/USDT symbols."""
+    url = "https://api.kraken.com/0/public/AssetPairs"
+    response = requests.get(url, timeout=10)
+    data = response.json()
+    pairs = {}
+    for name, v in data.get('result', {}).items():
+        wsname = v.get('wsname')
+        if wsname and wsname.endswith('/USDT'):
+            base, quote = wsname.split('/')
+            if base == 'XBT':
+                base = 'BTC'
+            pairs[name] = f"{base}/{quote}"
+    return pairs
+
+
 def fetch_kraken_tokens():
     try:
-        url = "https://api.kraken.com/0/public/AssetPairs"
-        response = requests.get(url, timeout=10)
-        data = response.json()
-        pairs = data.get('result', {})
-        tokens = []
-        for v in pairs.values():
-            wsname = v.get('wsname')
-            if wsname and wsname.endswith('/USDT'):
-                base, quote = wsname.split('/')
-                if base == 'XBT':
-                    base = 'BTC'
-                tokens.append(f"{base}/{quote}")
-        return tokens
+        return list(fetch_kraken_pairs().values())
     except Exception as e:
         logger.error(f"Failed to fetch Kraken tokens via API: {e}")
         return []
@@ -243,149 +308,734 @@ async def fetch_exchange_tokens(user_id: int) -> dict:
     return tokens
 
 
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_unknown_symbol(error) -> bool:
+    """True if a venue rejected a request only because it does not list the symbol."""
+    if isinstance(error, ccxt.BadSymbol):
+        return True
+    if isinstance(error, BinanceAPIException):
+        return error.code == -1121  # Invalid symbol
+    if isinstance(error, InvalidRequestError):
+        return error.status_code == 10001 and 'symbol' in str(error).lower()
+    return False
+
+
+class ExchangeHealth:
+    """Rolling latency and error tracking with circuit breakers and hedged reads.
+
+    Stats are kept per (exchange, endpoint). Timeouts follow the observed p99
+    latency, and hedged calls send a duplicate request once the first has been
+    outstanding longer than the p95 latency. Blocking calls run on a small thread
+    pool per exchange, so one slow venue cannot starve the others' requests.
+    """
+
+    def __init__(self):
+        self.latencies = {}  # {(exchange, endpoint): deque of seconds}
+        self.errors = {}  # {(exchange, endpoint): deque of bools}
+        self.open_until = {}  # {(exchange, endpoint): timestamp}
+        self.executors = {}  # {exchange: ThreadPoolExecutor}
+        self.slots = {}  # {exchange: asyncio.Semaphore}, one permit per executor thread
+
+    def _percentile(self, key, pct):
+        samples = sorted(self.latencies.get(key, ()))
+        if len(samples) < BREAKER_MIN_SAMPLES:
+            return None
+        return samples[int(pct * (len(samples) - 1))]
+
+    def timeout(self, exchange, endpoint) -> float:
+        p99 = self._percentile((exchange, endpoint), 0.99)
+        if p99 is None:
+            return MAX_TIMEOUT
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, p99 * 2))
+
+    def hedge_delay(self, exchange, endpoint) -> float:
+        p95 = self._percentile((exchange, endpoint), 0.95)
+        return max(MIN_HEDGE_DELAY, p95 or MIN_HEDGE_DELAY)
+
+    def is_open(self, exchange, endpoint) -> bool:
+        return time.time() < self.open_until.get((exchange, endpoint), 0)
+
+    def add_latency(self, exchange, endpoint, latency):
+        self.latencies.setdefault((exchange, endpoint), deque(maxlen=HEALTH_WINDOW)).append(latency)
+
+    def record(self, exchange, endpoint, latency, failed):
+        """Record a call outcome; latency may be None when it is recorded separately."""
+        key = (exchange, endpoint)
+        errors = self.errors.setdefault(key, deque(maxlen=HEALTH_WINDOW))
+        errors.append(failed)
+        if not failed:
+            if latency is not None:
+                self.add_latency(exchange, endpoint, latency)
+            if key in self.open_until:
+                # First success after a cool-down closes the circuit with a clean slate
+                del self.open_until[key]
+                errors.clear()
+            return
+        if key in self.open_until or (
+                len(errors) >= BREAKER_MIN_SAMPLES and sum(errors) / len(errors) >= BREAKER_ERROR_RATE):
+            self.open_until[key] = time.time() + BREAKER_COOLDOWN
+            logger.warning(f"Circuit open for {exchange} {endpoint}: skipping for {BREAKER_COOLDOWN}s")
+
+    def _slot(self, exchange):
+        if exchange not in self.slots:
+            self.slots[exchange] = asyncio.Semaphore(EXCHANGE_WORKERS)
+            self.executors[exchange] = ThreadPoolExecutor(EXCHANGE_WORKERS, thread_name_prefix=f"{exchange}-")
+        return self.slots[exchange]
+
+    def _submit(self, exchange, endpoint, fetch, slot, started):
+        loop = asyncio.get_running_loop()
+
+        def finished(future):
+            # Runs when the request really ends, even if its caller timed out or lost a hedge,
+            # so slow requests still count towards the percentiles
+            ok = not future.cancelled() and future.exception() is None
+            latency = time.monotonic() - started if ok else None
+            try:
+                loop.call_soon_threadsafe(self._release, slot, exchange, endpoint, latency)
+            except RuntimeError:
+                pass  # event loop already closed
+
+        future = self.executors[exchange].submit(fetch)
+        future.add_done_callback(finished)
+        return future
+
+    def _release(self, slot, exchange, endpoint, latency):
+        slot.release()
+        if latency is not None:
+            self.add_latency(exchange, endpoint, latency)
+
+    async def _attempt(self, exchange, endpoint, fetch, blocking):
+        if blocking:
+            slot = self._slot(exchange)
+            # Wait for a free thread before starting the clock: time spent queued behind
+            # earlier calls says nothing about the venue, so it is neither timed nor recorded
+            await slot.acquire()
+        timeout = self.timeout(exchange, endpoint)
+        started = time.monotonic()
+        try:
+            if blocking:
+                # The thread keeps its slot until the request ends, even if we stop waiting
+                request = asyncio.wrap_future(self._submit(exchange, endpoint, fetch, slot, started))
+            else:
+                request = fetch()
+            result = await asyncio.wait_for(request, timeout)
+        except asyncio.CancelledError:
+            if not blocking:
+                # A losing hedge: keep how long it had run so percentiles are not skewed to the winners
+                self.add_latency(exchange, endpoint, time.monotonic() - started)
+            raise
+        except Exception as e:
+            if is_unknown_symbol(e):
+                # The venue answered; it just does not list this symbol
+                return None
+            self.record(exchange, endpoint, None, True)
+            raise
+        self.record(exchange, endpoint, None if blocking else time.monotonic() - started, False)
+        return result
+
+    async def call(self, exchange, endpoint, fetch, hedge=False, blocking=False):
+        """Run fetch under the endpoint's breaker and timeout.
+
+        fetch is a coroutine function, or a plain function run on the exchange's
+        threads when blocking=True. With hedge=True (idempotent reads only) a second
+        attempt is started if the first is still pending after hedge_delay and the
+        exchange has a free thread; the first success wins. Returns None if the venue
+        does not list the requested symbol.
+        """
+        if self.is_open(exchange, endpoint):
+            raise CircuitOpenError(f"{exchange} {endpoint} circuit is open")
+        first = asyncio.create_task(self._attempt(exchange, endpoint, fetch, blocking))
+        if not hedge:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay(exchange, endpoint))
+        if done:
+            return first.result()
+        if blocking and self._slot(exchange).locked():
+            # Every thread is busy, so a duplicate would only queue behind the first request
+            return await first
+        logger.debug(f"Hedging slow {endpoint} request on {exchange}")
+        pending = {first, asyncio.create_task(self._attempt(exchange, endpoint, fetch, blocking))}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def summary(self) -> dict:
+        return {
+            f"{exchange} {endpoint}": {
+                "p99": self._percentile((exchange, endpoint), 0.99),
+                "error_rate": sum(errors) / len(errors) if errors else 0.0,
+                "open": self.is_open(exchange, endpoint),
+            }
+            for (exchange, endpoint), errors in self.errors.items()
+        }
+
+
+exchange_health = ExchangeHealth()
+
+
+class Quote:
+    """Top-of-book quote from one exchange. Timestamps are epoch seconds; exchange_ts is 0 if unknown."""
+    __slots__ = ('bid', 'ask', 'bid_size', 'ask_size', 'exchange_ts', 'received_ts')
+
+    def __init__(self, bid, ask, bid_size=0.0, ask_size=0.0, exchange_ts=0.0, received_ts=None):
+        self.bid = bid
+        self.ask = ask
+        self.bid_size = bid_size
+        self.ask_size = ask_size
+        self.exchange_ts = exchange_ts
+        self.received_ts = time.time() if received_ts is None else received_ts
+
+    def age(self, now=None) -> float:
+        return (now or time.time()) - (self.exchange_ts or self.received_ts)
+
+    def __repr__(self):
+        return f"Quote(bid={self.bid}, ask={self.ask}, bid_size={self.bid_size}, ask_size={self.ask_size})"
+
+
+def make_quote(bid, ask, bid_size=None, ask_size=None, exchange_ts_ms=None):
+    """Build a Quote from raw exchange fields, or None if either side of the book is empty."""
+    if not bid or not ask or float(bid) <= 0 or float(ask) <= 0:
+        return None
+    return Quote(
+        float(bid),
+        float(ask),
+        float(bid_size or 0),
+        float(ask_size or 0),
+        float(exchange_ts_ms) / 1000 if exchange_ts_ms else 0.0,
+    )
+
+
 async def get_market_prices(token: str) -> dict:
+    """Fetch {exchange: Quote} for token from every venue."""
     prices = {}
     base, quote = token.split('/')
     symbol_noslash = f"{base}{quote}"
     symbol_dash = f"{base}-{quote}"
 
-    async def fetch_bybit_price():
-        if quote == "USDT" and bybit:
-            try:
-                result = await asyncio.to_thread(
-                    bybit.get_tickers, category="spot", symbol=symbol_noslash
-                )
-                return 'bybit', float(result["result"]["list"][0]["lastPrice"])
-            except Exception as e:
-                logger.warning(f"Price fetch failed for {token} on bybit: {e}")
-                return 'bybit', None
-        return 'bybit', None
+    def fetch_bybit_price():
+        result = bybit.get_tickers(category="spot", symbol=symbol_noslash)
+        if not result["result"]["list"]:
+            return None
+        ticker = result["result"]["list"][0]
+        return make_quote(ticker["bid1Price"], ticker["ask1Price"], ticker["bid1Size"], ticker["ask1Size"],
+                          result.get("time"))
 
-    async def fetch_binance_price():
-        if binance:
-            try:
-                result = await asyncio.to_thread(
-                    binance.get_symbol_ticker, symbol=symbol_noslash
-                )
-                return 'binance', float(result["price"])
-            except Exception as e:
-                logger.warning(f"Price fetch failed for {token} on binance: {e}")
-                return 'binance', None
-        return 'binance', None
+    def fetch_binance_price():
+        result = binance.get_orderbook_ticker(symbol=symbol_noslash)
+        return make_quote(result["bidPrice"], result["askPrice"], result["bidQty"], result["askQty"])
 
-    async def fetch_ccxt_price(ex_id, ex):
-        try:
+    def fetch_ccxt_price(ex):
+        async def fetch():
             result = await ex.fetch_ticker(token)
-            return ex_id, float(result['last'])
-        except Exception as e:
-            logger.warning(f"Price fetch failed for {token} on {ex_id}: {e}")
-            return ex_id, None
-
-    async def fetch_kraken_price():
-        try:
-            response = requests.get(
-                "https://api.kraken.com/0/public/Ticker",
-                params={"pair": symbol_noslash},
-                timeout=10
-            )
-            response.raise_for_status()
-            data = response.json()
-            result = list(data["result"].values())[0]
-            return 'kraken', float(result["c"][0])
-        except Exception as e:
-            logger.warning(f"Price fetch failed for {token} on kraken: {e}")
-            return 'kraken', None
+            return make_quote(result['bid'], result['ask'], result.get('bidVolume'), result.get('askVolume'),
+                              result.get('timestamp'))
+        return fetch
+
+    def fetch_kraken_price():
+        response = requests.get(
+            "https://api.kraken.com/0/public/Ticker",
+            params={"pair": symbol_noslash},
+            timeout=exchange_health.timeout('kraken', 'ticker')
+        )
+        response.raise_for_status()
+        data = response.json()
+        if not data.get("result"):
+            return None  # Kraken does not list this pair
+        result = next(iter(data["result"].values()))
+        # a/b are [price, whole lot volume, lot volume]
+        return make_quote(result["b"][0], result["a"][0], result["b"][2], result["a"][2])
+
+    def fetch_okx_price():
+        url = f'https://www.okx.com/api/v5/market/ticker?instId={symbol_dash}'
+        response = requests.get(url, timeout=exchange_health.timeout('okx', 'ticker'))
+        response.raise_for_status()
+        data = response.json()
+        if 'data' in data and data['data']:
+            ticker = data['data'][0]
+            return make_quote(ticker['bidPx'], ticker['askPx'], ticker['bidSz'], ticker['askSz'], ticker['ts'])
+        return None
 
-    async def fetch_okx_price():
+    async def fetch_price(ex_id, fetch, blocking=True):
+        if fetch is None:
+            return ex_id, None
         try:
-            url = f'https://www.okx.com/api/v5/market/ticker?instId={symbol_dash}'
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            if 'data' in data and data['data']:
-                return 'okx', float(data['data'][0]['last'])
-            return 'okx', None
+            return ex_id, await exchange_health.call(ex_id, 'ticker', fetch, hedge=True, blocking=blocking)
+        except CircuitOpenError:
+            logger.debug(f"Skipping {token} on {ex_id}: circuit open")
         except Exception as e:
-            logger.warning(f"Price fetch failed for {token} on okx: {e}")
-            return 'okx', None
+            logger.warning(f"Price fetch failed for {token} on {ex_id}: {e!r}")
+        return ex_id, None
 
     # Run all price fetches concurrently
     tasks = [
-                fetch_bybit_price(),
-                fetch_binance_price(),
-                fetch_kraken_price(),
-                fetch_okx_price(),
-            ] + [fetch_ccxt_price(ex_id, ex) for ex_id, ex in ccxt_exchanges.items()]
+                fetch_price('bybit', fetch_bybit_price if quote == "USDT" and bybit else None),
+                fetch_price('binance', fetch_binance_price if binance else None),
+                fetch_price('kraken', fetch_kraken_price),
+                fetch_price('okx', fetch_okx_price),
+            ] + [fetch_price(ex_id, fetch_ccxt_price(ccxt_exchanges[ex_id]), blocking=False)
+                 for ex_id in CCXT_MARKET_DATA]
 
     results = await asyncio.gather(*tasks, return_exceptions=True)
 
-    for ex_id, price in results:
-        if price is not None:
-            prices[ex_id] = price
-            logger.debug(f"Fetched price for {token} on {ex_id}: {price}")
+    for ex_id, q in results:
+        if q is not None:
+            prices[ex_id] = q
+            logger.debug(f"Fetched quote for {token} on {ex_id}: {q}")
 
     return prices
 
 
-def analyze_arbitrage(prices: dict, token: str, fees: dict) -> dict:
-    if len(prices) < 2:
-        logger.debug(f"Skipping arbitrage for {token}: fewer than 2 prices available")
+async def get_all_market_prices(tokens, kraken_pairs: dict) -> dict:
+    """Fetch {token: {exchange: Quote}} for many tokens with one bulk ticker request per venue."""
+    wanted = set(tokens)
+
+    def fetch_binance_tickers():
+        result = binance.get_orderbook_tickers()
+        return [
+            (f"{t['symbol'][:-4]}/USDT", make_quote(t['bidPrice'], t['askPrice'], t['bidQty'], t['askQty']))
+            for t in result
+            if t['symbol'].endswith("USDT")
+        ]
+
+    def fetch_bybit_tickers():
+        result = bybit.get_tickers(category="spot")
+        return [
+            (f"{t['symbol'][:-4]}/USDT",
+             make_quote(t['bid1Price'], t['ask1Price'], t['bid1Size'], t['ask1Size'], result.get("time")))
+            for t in result["result"]["list"]
+            if t['symbol'].endswith("USDT")
+        ]
+
+    def fetch_kraken_tickers():
+        # Without a pair parameter Kraken returns every tradeable pair
+        response = requests.get(
+            "https://api.kraken.com/0/public/Ticker", timeout=exchange_health.timeout('kraken', 'tickers')
+        )
+        response.raise_for_status()
+        return [
+            (kraken_pairs[name], make_quote(t["b"][0], t["a"][0], t["b"][2], t["a"][2]))
+            for name, t in response.json()["result"].items()
+            if name in kraken_pairs
+        ]
+
+    def fetch_okx_tickers():
+        response = requests.get(
+            "https://www.okx.com/api/v5/market/tickers",
+            params={"instType": "SPOT"},
+            timeout=exchange_health.timeout('okx', 'tickers')
+        )
+        response.raise_for_status()
+        return [
+            (t['instId'].replace('-', '/'), make_quote(t['bidPx'], t['askPx'], t['bidSz'], t['askSz'], t['ts']))
+            for t in response.json()['data']
+            if t['instId'].endswith('-USDT')
+        ]
+
+    def fetch_ccxt_tickers(ex):
+        async def fetch():
+            tickers = await ex.fetch_tickers()
+            return [
+                (symbol, make_quote(t['bid'], t['ask'], t.get('bidVolume'), t.get('askVolume'), t.get('timestamp')))
+                for symbol, t in tickers.items()
+                if symbol in wanted
+            ]
+        return fetch
+
+    fetchers = {
+        'binance': fetch_binance_tickers if binance else None,
+        'bybit': fetch_bybit_tickers if bybit else None,
+        'kraken': fetch_kraken_tickers if kraken_pairs else None,
+        'okx': fetch_okx_tickers,
+    }
+    fetchers.update({ex_id: fetch_ccxt_tickers(ccxt_exchanges[ex_id]) for ex_id in CCXT_MARKET_DATA})
+    fetchers = {ex_id: fetch for ex_id, fetch in fetchers.items() if fetch is not None}
+    results = await asyncio.gather(
+        *(exchange_health.call(ex_id, 'tickers', fetch, blocking=ex_id not in CCXT_MARKET_DATA)
+          for ex_id, fetch in fetchers.items()),
+        return_exceptions=True
+    )
+
+    quotes = {}
+    for ex_id, result in zip(fetchers, results):
+        if isinstance(result, CircuitOpenError):
+            logger.debug(f"Skipping bulk tickers on {ex_id}: circuit open")
+        elif isinstance(result, Exception):
+            logger.warning(f"Bulk ticker fetch failed on {ex_id}: {result!r}")
+        else:
+            for token, q in result:
+                if q is not None and token in wanted:
+                    quotes.setdefault(token, {})[ex_id] = q
+    return quotes
+
+
+async def fetch_order_books(token: str, depth: int = ORDER_BOOK_DEPTH) -> dict:
+    """Fetch {exchange: {"bids": [(price, qty)], "asks": [(price, qty)]}} from every venue."""
+    base, quote = token.split('/')
+    symbol_noslash = f"{base}{quote}"
+    symbol_dash = f"{base}-{quote}"
+
+    def levels(rows):
+        return [(float(row[0]), float(row[1])) for row in rows]
+
+    def fetch_binance_book():
+        result = binance.get_order_book(symbol=symbol_noslash, limit=depth)
+        return {"bids": levels(result["bids"]), "asks": levels(result["asks"])}
+
+    def fetch_bybit_book():
+        result = bybit.get_orderbook(category="spot", symbol=symbol_noslash, limit=depth)
+        return {"bids": levels(result["result"]["b"]), "asks": levels(result["result"]["a"])}
+
+    def fetch_kraken_book():
+        response = requests.get(
+            "https://api.kraken.com/0/public/Depth",
+            params={"pair": symbol_noslash, "count": depth},
+            timeout=exchange_health.timeout('kraken', 'order_book')
+        )
+        response.raise_for_status()
+        data = response.json()
+        if not data.get("result"):
+            return None  # Kraken does not list this pair
+        result = next(iter(data["result"].values()))
+        return {"bids": levels(result["bids"]), "asks": levels(result["asks"])}
+
+    def fetch_okx_book():
+        response = requests.get(
+            "https://www.okx.com/api/v5/market/books",
+            params={"instId": symbol_dash, "sz": depth},
+            timeout=exchange_health.timeout('okx', 'order_book')
+        )
+        response.raise_for_status()
+        data = response.json()
+        if not data.get("data"):
+            return None  # OKX does not list this instrument
+        book = data["data"][0]
+        return {"bids": levels(book["bids"]), "asks": levels(book["asks"])}
+
+    def fetch_ccxt_book(ex):
+        async def fetch():
+            result = await ex.fetch_order_book(token, depth)
+            return {"bids": levels(result["bids"]), "asks": levels(result["asks"])}
+        return fetch
+
+    fetchers = {
+        'binance': fetch_binance_book if binance else None,
+        'bybit': fetch_bybit_book if quote == "USDT" and bybit else None,
+        'kraken': fetch_kraken_book,
+        'okx': fetch_okx_book,
+    }
+    fetchers.update({ex_id: fetch_ccxt_book(ccxt_exchanges[ex_id]) for ex_id in CCXT_MARKET_DATA})
+    fetchers = {ex_id: fetch for ex_id, fetch in fetchers.items() if fetch is not None}
+    results = await asyncio.gather(
+        *(exchange_health.call(ex_id, 'order_book', fetch, hedge=True, blocking=ex_id not in CCXT_MARKET_DATA)
+          for ex_id, fetch in fetchers.items()),
+        return_exceptions=True
+    )
+
+    order_books = {}
+    for ex_id, result in zip(fetchers, results):
+        if isinstance(result, CircuitOpenError):
+            logger.debug(f"Skipping {token} order book on {ex_id}: circuit open")
+        elif isinstance(result, Exception):
+            logger.warning(f"Order book fetch failed for {token} on {ex_id}: {result!r}")
+        elif result and result["bids"] and result["asks"]:
+            order_books[ex_id] = result
+    return order_books
+
+
+def fetch_binance_fees() -> dict:
+    info = binance.get_trade_fee()
+    return {
+        f"{item['symbol'][:-4]}/USDT": float(item['takerCommission']) * 100
+        for item in info
+        if item['symbol'].endswith("USDT")
+    }
+
+
+def fetch_bybit_fees() -> dict:
+    response = bybit.get_fee_rates(category="spot")
+    return {
+        f"{item['symbol'][:-4]}/USDT": float(item['takerFeeRate']) * 100
+        for item in response["result"]["list"]
+        if item['symbol'].endswith("USDT")
+    }
+
+
+async def fetch_kraken_fees(exchange, symbols) -> dict:
+    """Taker fees for many symbols with one TradeVolume request per batch of pairs."""
+    await exchange.load_markets()
+    ids = [exchange.market(symbol)['id'] for symbol in symbols if symbol in exchange.markets]
+    fees = {}
+    for i in range(0, len(ids), FEE_BATCH_SIZE):
+        response = await exchange.private_post_tradevolume({'pair': ','.join(ids[i:i + FEE_BATCH_SIZE])})
+        for pair_id, fee in response['result'].get('fees', {}).items():
+            # Kraken reports fees in percent already
+            fees[exchange.safe_market(pair_id)['symbol']] = float(fee['fee'])
+    return fees
+
+
+async def fetch_ccxt_fees(ex_id, exchange, symbols) -> tuple:
+    """Return ({symbol: taker pct}, symbols looked up) for a venue with per-symbol fees.
+
+    Symbols whose lookup failed are left out of the second item, so they are retried.
+    """
+    if ex_id == 'kraken':
+        # A batch either answers for every pair it names or fails as a whole
+        return await fetch_kraken_fees(exchange, symbols), set(symbols)
+
+    # No bulk endpoint: look up each symbol (ccxt's rate limiter paces the requests)
+    async def fetch_one(symbol):
+        try:
+            fee = await exchange.fetch_trading_fee(symbol)
+            return symbol, fee.get('taker'), True
+        except ccxt.BadSymbol:
+            return symbol, None, True
+        except Exception as e:
+            logger.debug(f"Fee fetch failed for {symbol} on {ex_id}: {e}")
+            return symbol, None, False
+
+    results = await asyncio.gather(*(fetch_one(symbol) for symbol in symbols))
+    fees = {symbol: taker * 100 for symbol, taker, _ in results if taker is not None}
+    return fees, {symbol for symbol, _, looked_up in results if looked_up}
+
+
+def per_symbol_fee_venue(exchange) -> bool:
+    return exchange.has.get('fetchTradingFee') and not exchange.has.get('fetchTradingFees')
+
+
+async def load_symbol_fees(user_id: int, cached: dict, clients: dict, tokens: set):
+    """Background lookup of fees on venues that only report them per symbol."""
+
+    async def load(ex_id, exchange):
+        missing = tokens - cached["tokens"].get(ex_id, set())
+        if not missing:
+            return
+        try:
+            symbol_fees, looked_up = await fetch_ccxt_fees(ex_id, exchange, missing)
+        except Exception as e:
+            logger.warning(f"Fee fetch failed on {ex_id}, using default fee: {e}")
+            return
+        cached["fees"].setdefault(ex_id, {"default": DEFAULT_FEES.get(ex_id, 0.1)}).update(symbol_fees)
+        cached["tokens"].setdefault(ex_id, set()).update(looked_up)
+        logger.info(f"Loaded {len(symbol_fees)} symbol fees on {ex_id} for user {user_id}")
+
+    await asyncio.gather(*(load(ex_id, exchange) for ex_id, exchange in clients.items()))
+
+
+async def load_trading_fees(user_id: int, tokens) -> dict:
+    """Load the user's taker fees (in %) per exchange and symbol, cached for FEE_CACHE_TTL.
+
+    Venues with a bulk fee endpoint are loaded once per TTL and awaited. Venues that
+    only report fees per symbol are looked up in the background so a scan never
+    waits on them; until their answers arrive those symbols use the venue default.
+    """
+    tokens = set(tokens)
+    cached = fee_cache.get(user_id)
+    if not cached or time.time() - cached["loaded_at"] >= FEE_CACHE_TTL:
+        cached = {"loaded_at": time.time(), "fees": {}, "tokens": {}, "pending": None}
+        fee_cache[user_id] = cached
+
+        async def load(ex_id):
+            try:
+                if ex_id == 'binance':
+                    return ex_id, await asyncio.to_thread(fetch_binance_fees) if binance else {}
+                if ex_id == 'bybit':
+                    return ex_id, await asyncio.to_thread(fetch_bybit_fees) if bybit else {}
+                exchange = ccxt_exchanges[ex_id]
+                if exchange.has.get('fetchTradingFees'):
+                    fees = await exchange.fetch_trading_fees()
+                    return ex_id, {symbol: fee['taker'] * 100 for symbol, fee in fees.items()
+                                   if fee.get('taker') is not None}
+                if not exchange.has.get('fetchTradingFee'):
+                    logger.warning(f"{ex_id} has no account fee endpoint, using default fee")
+            except Exception as e:
+                logger.warning(f"Fee fetch failed on {ex_id}, using default fee: {e}")
+            return ex_id, {}
+
+        results = await asyncio.gather(*(load(ex_id) for ex_id in EXCHANGES))
+        for ex_id, symbol_fees in results:
+            cached["fees"].setdefault(ex_id, {"default": DEFAULT_FEES.get(ex_id, 0.1)}).update(symbol_fees)
+            if symbol_fees:
+                logger.info(f"Loaded {len(symbol_fees)} symbol fees on {ex_id} for user {user_id}")
+
+    pending = cached["pending"]
+    if pending is None or pending.done():
+        # Keep the clients this user's scan set up; a later /scan may rebind the module-level ones
+        clients = {ex_id: ex for ex_id, ex in ccxt_exchanges.items()
+                   if per_symbol_fee_venue(ex) and tokens - cached["tokens"].get(ex_id, set())}
+        if clients:
+            cached["pending"] = asyncio.create_task(load_symbol_fees(user_id, cached, clients, tokens))
+    return cached["fees"]
+
+
+def fee_vector(fees: dict, token: str) -> list:
+    """Taker fee (in %) for token on every exchange, indexed like EXCHANGES."""
+    vector = []
+    for ex_id in EXCHANGES:
+        ex_fees = fees.get(ex_id, {})
+        vector.append(ex_fees.get(token, ex_fees.get("default", DEFAULT_FEES.get(ex_id, 0.1))))
+    return vector
+
+
+def analyze_arbitrage(prices: dict, token: str, fees: dict, max_age: float = QUOTE_MAX_AGE) -> dict:
+    """Find the best fee-adjusted ask→bid spread across {exchange: Quote}, ignoring stale quotes."""
+    now = time.time()
+    quotes = {ex: q for ex, q in prices.items() if q.age(now) <= max_age}
+    if len(quotes) < len(prices):
+        logger.debug(f"Dropped {len(prices) - len(quotes)} stale quotes for {token}")
+    if len(quotes) < 2:
+        logger.debug(f"Skipping arbitrage for {token}: fewer than 2 fresh quotes available")
         return None
-    sorted_exchanges = sorted(prices.items(), key=lambda x: x[1])
-    buy_ex, buy_price = sorted_exchanges[0]
-    sell_ex, sell_price = sorted_exchanges[-1]
-    buy_fee = fees.get(buy_ex, 0.1)
-    sell_fee = fees.get(sell_ex, 0.1)
-    buy_total = buy_price * (1 + buy_fee / 100)
-    sell_total = sell_price * (1 - sell_fee / 100)
+    rates = fee_vector(fees, token)
+    # Fee-adjusted cost of buying at the ask and proceeds of selling at the bid, in one pass
+    buy_totals = {ex: q.ask * (1 + rates[EXCHANGE_INDEX[ex]] / 100) for ex, q in quotes.items()}
+    sell_totals = {ex: q.bid * (1 - rates[EXCHANGE_INDEX[ex]] / 100) for ex, q in quotes.items()}
+    buy_ex, sell_ex = max(
+        ((b, s) for b in buy_totals for s in sell_totals if b != s),
+        key=lambda pair: sell_totals[pair[1]] / buy_totals[pair[0]]
+    )
+    buy_quote, sell_quote = quotes[buy_ex], quotes[sell_ex]
+    buy_total, sell_total = buy_totals[buy_ex], sell_totals[sell_ex]
     profit_pct = ((sell_total - buy_total) / buy_total) * 100
     if profit_pct > 0.1:
-        return {
+        opportunity = {
             'token': token,
             'buy_exchange': buy_ex,
             'sell_exchange': sell_ex,
-            'buy_price': buy_price,
-            'sell_price': sell_price,
+            'buy_price': buy_quote.ask,
+            'sell_price': sell_quote.bid,
             'profit': round(profit_pct, 2)
         }
+        if buy_quote.ask_size and sell_quote.bid_size:
+            # Top-of-book depth, used by allocate_capital to cap the trade size
+            opportunity['max_notional'] = min(buy_quote.ask * buy_quote.ask_size,
+                                              buy_quote.ask * sell_quote.bid_size)
+        return opportunity
     logger.debug(f"No profitable arbitrage for {token}: profit {profit_pct:.2f}%")
     return None
 
 
-async def find_opportunities(user_id: int) -> list:
-    logger.info(f"Starting arbitrage scan for user {user_id}...")
-    tokens = await fetch_exchange_tokens(user_id)
-    logger.info(f"Fetched tokens for exchanges: { {ex: len(tokens[ex]) for ex in tokens} }")
+def route_order(order_books: dict, token: str, amount: float, fees: dict = None) -> list:
+    """Split a buy of `amount` USDT across venues against the best bids on other venues.
+
+    Asks from all venues are merged into one ascending stream and bids into one
+    descending stream (by fee-adjusted price); both are walked together while the
+    cheapest ask is still below the best bid. Returns one child leg per (buy venue,
+    sell venue) pair: {"buy_exchange", "sell_exchange", "amount" (USDT), "base_amount",
+    "buy_price", "sell_price", "profit" (% after fees)}.
+    """
+    rates = fee_vector(fees or {}, token)
+
+    def stream(side, sign):
+        # Each venue's levels are already sorted, so heapq.merge yields the global order lazily
+        per_venue = []
+        for ex_id, book in order_books.items():
+            factor = 1 + sign * rates[EXCHANGE_INDEX[ex_id]] / 100
+            per_venue.append([(sign * price * factor, price, qty, ex_id) for price, qty in book[side]])
+        return heapq.merge(*per_venue)
+
+    asks = stream("asks", 1)
+    bids = stream("bids", -1)
+    ask, bid = next(asks, None), next(bids, None)
+    ask_left = ask[2] if ask else 0.0
+    bid_left = bid[2] if bid else 0.0
+    remaining = amount
+    legs = {}
+    while ask and bid and remaining > 1e-9 and ask[0] < -bid[0]:
+        _, ask_price, _, buy_ex = ask
+        _, bid_price, _, sell_ex = bid
+        if buy_ex == sell_ex:
+            # A venue's own book is never crossed; skip levels from an inconsistent snapshot
+            bid = next(bids, None)
+            bid_left = bid[2] if bid else 0.0
+            continue
+        qty = min(ask_left, bid_left, remaining / ask_price)
+        leg = legs.setdefault((buy_ex, sell_ex),
+                              {"amount": 0.0, "base_amount": 0.0, "proceeds": 0.0, "net_cost": 0.0, "net_proceeds": 0.0})
+        leg["amount"] += qty * ask_price
+        leg["base_amount"] += qty
+        leg["proceeds"] += qty * bid_price
+        leg["net_cost"] += qty * ask[0]
+        leg["net_proceeds"] -= qty * bid[0]
+        remaining -= qty * ask_price
+        ask_left -= qty
+        bid_left -= qty
+        if ask_left <= 1e-12:
+            ask = next(asks, None)
+            ask_left = ask[2] if ask else 0.0
+        if bid_left <= 1e-12:
+            bid = next(bids, None)
+            bid_left = bid[2] if bid else 0.0
+
+    return [
+        {
+            "buy_exchange": buy_ex,
+            "sell_exchange": sell_ex,
+            "amount": round(leg["amount"], 2),
+            "base_amount": leg["base_amount"],
+            "buy_price": leg["amount"] / leg["base_amount"],
+            "sell_price": leg["proceeds"] / leg["base_amount"],
+            "profit": (leg["net_proceeds"] - leg["net_cost"]) / leg["net_cost"] * 100,
+        }
+        for (buy_ex, sell_ex), leg in legs.items()
+    ]
+
+
+def get_common_tokens(tokens: dict) -> set:
     exchanges = [ex for ex in tokens if tokens[ex]]
     if not exchanges:
         logger.error("No exchanges have tokens available.")
-        return []
+        return set()
     try:
-        token_sets = [set(tokens[ex]) for ex in exchanges]
-        if not token_sets:
-            logger.error("No token sets available for intersection.")
-            return []
-        common_tokens = set.intersection(*token_sets)
+        return set.intersection(*[set(tokens[ex]) for ex in exchanges])
     except Exception as e:
         logger.error(f"Error finding common tokens: {e}")
-        return []
-    logger.info(f"Number of common tokens: {len(common_tokens)}")
-    fees = {ex_id: DEFAULT_FEES.get(ex_id, 0.1) for ex_id in exchanges}
+        return set()
+
+
+async def find_opportunities(user_id: int) -> list:
+    logger.info(f"Starting arbitrage scan for user {user_id}...")
     opportunities = []
 
-    # Fetch prices for all tokens concurrently
-    async def process_token(token):
-        try:
-            logger.info(f"Checking arbitrage for token: {token}")
-            prices = await get_market_prices(token)
-            result = analyze_arbitrage(prices, token, fees)
-            return result
-        except Exception as e:
-            logger.error(f"Error processing token {token}: {e}")
-            return None
+    snapshot = read_market_snapshot()
+    if snapshot is not None:
+        logger.info(f"Using market data feed snapshot with {len(snapshot)} tokens")
+        fees = await load_trading_fees(user_id, snapshot)
+        results = [analyze_arbitrage(prices, token, fees) for token, prices in snapshot.items()]
+    else:
+        tokens = await fetch_exchange_tokens(user_id)
+        logger.info(f"Fetched tokens for exchanges: { {ex: len(tokens[ex]) for ex in tokens} }")
+        common_tokens = get_common_tokens(tokens)
+        if not common_tokens:
+            return []
+        logger.info(f"Number of common tokens: {len(common_tokens)}")
+        fees = await load_trading_fees(user_id, common_tokens)
 
-    tasks = [process_token(token) for token in common_tokens]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Fetch prices for all tokens concurrently
+        async def process_token(token):
+            try:
+                logger.info(f"Checking arbitrage for token: {token}")
+                prices = await get_market_prices(token)
+                result = analyze_arbitrage(prices, token, fees)
+                return result
+            except Exception as e:
+                logger.error(f"Error processing token {token}: {e}")
+                return None
+
+        tasks = [process_token(token) for token in common_tokens]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info(f"Exchange health: {exchange_health.summary()}")
 
     for result in results:
         if result and isinstance(result, dict):
@@ -398,6 +1048,134 @@ async def find_opportunities(user_id: int) -> list:
     return sorted_opportunities
 
 
+class MarketDataPublisher:
+    """Single writer of the market data ring buffer.
+
+    Each record carries its own sequence number: it is zeroed while the slot is
+    being rewritten, so readers can skip half-written records without locking.
+    """
+
+    def __init__(self, name=FEED_SHM_NAME, slots=FEED_SLOTS):
+        size = FEED_HEADER.size + slots * FEED_RECORD.size
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            existing = shared_memory.SharedMemory(name=name)
+            _, _, updated_at = FEED_HEADER.unpack_from(existing.buf, 0)
+            if time.time() - updated_at <= FEED_STALE_AFTER:
+                # Another feed is still publishing; keep the resource tracker from unlinking its segment
+                resource_tracker.unregister(existing._name, 'shared_memory')
+                existing.close()
+                raise RuntimeError(f"A market data feed is already publishing to shared memory '{name}'")
+            # Segment left behind by a feed that did not shut down cleanly
+            existing.close()
+            existing.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.slots = slots
+        self.seq = 0
+        # Stamp the header now so a second feed started during our first sweep sees this one as live
+        FEED_HEADER.pack_into(self.shm.buf, 0, 0, slots, time.time())
+
+    def publish(self, token: str, prices: dict):
+        """Write {exchange: Quote} for token into the ring buffer."""
+        buf = self.shm.buf
+        token_bytes = token.encode()
+        if len(token_bytes) > 24:
+            logger.debug(f"Token {token} too long for the market data feed, skipping")
+            return
+        now = time.time()
+        for ex_id, q in prices.items():
+            self.seq += 1
+            offset = FEED_HEADER.size + (self.seq % self.slots) * FEED_RECORD.size
+            FEED_SEQ.pack_into(buf, offset, 0)
+            FEED_RECORD.pack_into(buf, offset, 0, token_bytes, EXCHANGE_INDEX[ex_id],
+                                  q.bid, q.ask, q.bid_size, q.ask_size, q.exchange_ts, q.received_ts)
+            FEED_SEQ.pack_into(buf, offset, self.seq)
+        FEED_HEADER.pack_into(buf, 0, self.seq, self.slots, now)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach_market_data(name=FEED_SHM_NAME):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    # Older Pythons register attached segments with the resource tracker, which
+    # would unlink the feed's memory when this worker exits.
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def read_market_snapshot(name=FEED_SHM_NAME):
+    """Return the latest {token: {exchange: Quote}} from the feed, or None if no feed is running."""
+    try:
+        shm = attach_market_data(name)
+    except FileNotFoundError:
+        return None
+    try:
+        buf = shm.buf
+        last_seq, slots, updated_at = FEED_HEADER.unpack_from(buf, 0)
+        if time.time() - updated_at > FEED_STALE_AFTER:
+            logger.warning("Market data feed is stale, fetching prices directly")
+            return None
+        if not last_seq:
+            logger.info("Market data feed has not published yet, fetching prices directly")
+            return None
+        latest = {}
+        for i in range(slots):
+            offset = FEED_HEADER.size + i * FEED_RECORD.size
+            record = FEED_RECORD.unpack_from(buf, offset)
+            seq = record[0]
+            # Skip empty slots and slots rewritten while we were reading them
+            if not seq or FEED_SEQ.unpack_from(buf, offset)[0] != seq:
+                continue
+            key = (record[1], record[2])
+            if key not in latest or latest[key][0] < seq:
+                latest[key] = record
+        del buf
+        snapshot = {}
+        for (token_bytes, ex_idx), record in latest.items():
+            snapshot.setdefault(token_bytes.rstrip(b'\0').decode(), {})[EXCHANGES[ex_idx]] = Quote(*record[3:])
+        return snapshot
+    finally:
+        shm.close()
+
+
+async def run_market_data_feed():
+    """Own all exchange connections and publish prices for bot workers."""
+    global binance, bybit
+    # Public market data does not need user keys
+    binance = BinanceClient()
+    bybit = BybitClient()
+    publisher = MarketDataPublisher()
+    logger.info(f"Market data feed publishing to shared memory '{publisher.shm.name}'")
+    common_tokens, kraken_pairs, tokens_loaded_at = [], {}, 0
+    try:
+        while True:
+            started = time.time()
+            if started - tokens_loaded_at > FEED_TOKEN_REFRESH:
+                tokens = await fetch_exchange_tokens(0)
+                common_tokens = list(get_common_tokens(tokens))
+                try:
+                    kraken_pairs = await asyncio.to_thread(fetch_kraken_pairs)
+                except Exception as e:
+                    logger.error(f"Failed to fetch Kraken pairs: {e}")
+                tokens_loaded_at = started
+                logger.info(f"Market data feed tracking {len(common_tokens)} tokens")
+            # One bulk ticker request per venue per sweep keeps the feed within public rate limits
+            quotes = await get_all_market_prices(common_tokens, kraken_pairs)
+            for token, prices in quotes.items():
+                publisher.publish(token, prices)
+            logger.debug(f"Market data sweep took {time.time() - started:.2f}s")
+            await asyncio.sleep(max(0.0, FEED_INTERVAL - (time.time() - started)))
+    finally:
+        publisher.close()
+        for exchange in ccxt_exchanges.values():
+            await exchange.close()
+
+
 def get_exchange_url(exchange, token):
     base, quote = token.split('/')
     if exchange == 'binance':
@@ -446,22 +1224,15 @@ async def scan_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global binance, bybit
     try:
         # Initialize clients with user keys
-        for ex_id in user_data[user_id]:
+        for ex_id, keys in user_data[user_id].items():
             if ex_id == "binance":
-                binance = BinanceClient(user_data[user_id][ex_id]["api_key"], user_data[user_id][ex_id]["api_secret"])
+                binance = make_client(ex_id, keys)
             elif ex_id == "bybit":
-                bybit = BybitClient(api_key=user_data[user_id][ex_id]["api_key"],
-                                    api_secret=user_data[user_id][ex_id]["api_secret"])
+                bybit = make_client(ex_id, keys)
             elif ex_id in ccxt_exchanges:
-                config = {
-                    "apiKey": user_data[user_id][ex_id]["api_key"],
-                    "secret": user_data[user_id][ex_id]["api_secret"],
-                    "enableRateLimit": True,
-                }
-                if ex_id == "okx" and user_data[user_id][ex_id]["passphrase"]:
-                    config["password"] = user_data[user_id][ex_id]["passphrase"]
-                ccxt_exchanges[ex_id] = getattr(ccxt, ex_id)(config)
+                ccxt_exchanges[ex_id] = make_client(ex_id, keys)
         opportunities = await find_opportunities(user_id)
+        context.user_data["opportunities"] = opportunities
         messages = format_opportunities_with_buttons(opportunities)
         for msg, keyboard in messages:
             await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=keyboard)
@@ -518,48 +1289,12 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         sell_ex = arbitrage_data["sell_exchange"]
         network = arbitrage_data["network"]
 
-        # Initialize exchange operations
-        exchange_map = {
-            'binance': BinanceOps(binance),
-            'bybit': BybitOps(bybit),
-            'kucoin': KucoinOps(ccxt_exchanges['kucoin']),
-            'kraken': KrakenOps(ccxt_exchanges['kraken']),
-            'bingx': BingxOps(ccxt_exchanges['bingx']),
-            'okx': OkxOps(ccxt_exchanges['okx']),
-        }
-        buy_ops = exchange_map[buy_ex]
-        sell_ops = exchange_map[sell_ex]
-
-        # 1. Buy on buy_exchange
-        await update.message.reply_text(f"Placing buy order for {token} on {buy_ex}...")
-        buy_order = buy_ops.buy(token, amount)
-        await update.message.reply_text(f"Bought {token} on {buy_ex}: {buy_order}")
-
-        # 2. Fetch deposit address from sell_exchange
-        asset = token.split('/')[0]
-        await update.message.reply_text(f"Fetching deposit address for {asset} on {sell_ex}...")
-        deposit_address = sell_ops.get_deposit_address(asset, network)
-        await update.message.reply_text(f"Deposit address: {deposit_address}")
-
-        # 3. Withdraw from buy_exchange to sell_exchange
-        await update.message.reply_text(f"Withdrawing {asset} to {sell_ex}...")
-        withdraw = buy_ops.withdraw(asset, amount, deposit_address, network)
-        await update.message.reply_text(f"Withdrew {asset} to {sell_ex}: {withdraw}")
-
-        # 4. Wait for deposit
-        await update.message.reply_text(f"Waiting for deposit of {asset} on {sell_ex}...")
-        deposited = sell_ops.wait_for_deposit(asset, amount)
-        if not deposited:
-            await update.message.reply_text(f"Deposit not detected on {sell_ex} after waiting. Aborting.")
-            return
-        await update.message.reply_text(f"Deposit confirmed on {sell_ex}.")
-
-        # 5. Sell on sell_exchange
-        await update.message.reply_text(f"Placing sell order for {token} on {sell_ex}...")
-        sell_order = sell_ops.sell(token, amount)
-        await update.message.reply_text(f"Sold {token} on {sell_ex}: {sell_order}")
-
-        await update.message.reply_text("Arbitrage completed!")
+        exchange_map = build_exchange_ops(user_id)
+        try:
+            await execute_arbitrage(user_id, exchange_map, token, buy_ex, sell_ex, network, amount,
+                                    update.message.reply_text)
+        finally:
+            await close_exchange_ops(exchange_map)
     except ValueError as e:
         logger.error(f"Error processing amount for user {user_id}: {str(e)}")
         await update.message.reply_text(f"Error: {str(e)}")
@@ -586,23 +1321,363 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.pop("arbitrage_data", None)
 
 
+def make_client(ex_id, keys):
+    """Create an exchange client authenticated with one user's keys."""
+    if ex_id == "binance":
+        return BinanceClient(keys["api_key"], keys["api_secret"])
+    if ex_id == "bybit":
+        return BybitClient(api_key=keys["api_key"], api_secret=keys["api_secret"])
+    config = {
+        "apiKey": keys["api_key"],
+        "secret": keys["api_secret"],
+        "enableRateLimit": True,
+    }
+    if ex_id == "okx" and keys["passphrase"]:
+        config["password"] = keys["passphrase"]
+    return getattr(ccxt, ex_id)(config)
+
+
+def build_exchange_ops(user_id: int) -> dict:
+    """Exchange operations on clients built from this user's keys.
+
+    Built once per execution: /scan rebinds the module-level clients to whoever
+    scanned last, so trades must never go through those.
+    """
+    ops_classes = {
+        'binance': BinanceOps,
+        'bybit': BybitOps,
+        'kucoin': KucoinOps,
+        'kraken': KrakenOps,
+        'bingx': BingxOps,
+        'okx': OkxOps,
+    }
+    return {ex_id: ops_classes[ex_id](make_client(ex_id, keys)) for ex_id, keys in user_data.get(user_id, {}).items()}
+
+
+async def close_exchange_ops(exchange_map: dict):
+    for ops in exchange_map.values():
+        close = getattr(ops.client, 'close', None)
+        if inspect.iscoroutinefunction(close):
+            await close()
+
+
+async def run_blocking(fn, *args):
+    """Run an exchange call off the event loop, awaiting it if the client is async (ccxt)."""
+    result = await asyncio.to_thread(fn, *args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+async def call_exchange(exchange, fn, *args):
+    """Run an exchange call within that exchange's concurrency limit."""
+    async with exchange_limits[exchange]:
+        return await run_blocking(fn, *args)
+
+
+class BalanceLedger:
+    """Balance reservations shared by every trade the bot runs.
+
+    A buy reserves its USDT against the live balance and releases it once the order
+    has returned, by which point the exchange balance reflects the spend. Fetching the
+    balance and reserving happen under one lock per (user, exchange, asset), so
+    concurrent trades on the same account are never granted the same funds.
+    """
+
+    def __init__(self):
+        self.reserved = {}  # {(user_id, exchange, asset): amount}
+        self.locks = {}
+
+    async def reserve(self, user_id, exchange, asset, amount, get_balance) -> float:
+        key = (user_id, exchange, asset)
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            balance = float(await get_balance())
+            granted = max(0.0, min(amount, balance - self.reserved.get(key, 0.0)))
+            self.reserved[key] = self.reserved.get(key, 0.0) + granted
+            return granted
+
+    def release(self, user_id, exchange, asset, amount):
+        key = (user_id, exchange, asset)
+        self.reserved[key] = max(0.0, self.reserved.get(key, 0.0) - amount)
+
+
+balance_ledger = BalanceLedger()
+# Held from withdrawal until the sell, one per (user, sell exchange, asset): wait_for_deposit
+# matches any new deposit of at least the expected size, so only one transfer may be in flight
+deposit_locks = {}
+exchange_limits = {ex_id: asyncio.Semaphore(EXCHANGE_CONCURRENCY.get(ex_id, 1)) for ex_id in EXCHANGES}
+
+
+async def execute_arbitrage(user_id, exchange_map, token, buy_ex, sell_ex, network, amount, notify,
+                            allow_partial=False, base_amount=None, buy_fee=0.0) -> bool:
+    """Buy for `amount` USDT, move the coins and sell them.
+
+    base_amount is the token quantity bought for `amount`. Venues that size market buys
+    in the base asset are sent it, and what is withdrawn and sold is base_amount less
+    the buy fee (in %), rounded down to both markets' lot sizes. Without base_amount,
+    `amount` is used for every step.
+    """
+    buy_ops = exchange_map[buy_ex]
+    sell_ops = exchange_map[sell_ex]
+
+    # 0. Reserve USDT on buy_exchange so concurrent trades cannot spend it twice
+    reserved = await balance_ledger.reserve(user_id, buy_ex, 'USDT', amount,
+                                            lambda: call_exchange(buy_ex, buy_ops.get_balance, 'USDT'))
+    if reserved < (MIN_TRADE_AMOUNT if allow_partial else amount):
+        balance_ledger.release(user_id, buy_ex, 'USDT', reserved)
+        await notify(f"Not enough free USDT on {buy_ex}: {reserved:.2f} available for this trade.")
+        return False
+    if reserved < amount:
+        if base_amount is not None:
+            base_amount *= reserved / amount
+        amount = int(reserved * 100) / 100
+
+    try:
+        if base_amount is None:
+            quantity, order_size = amount, amount
+        else:
+            # The buy fee is usually taken in the bought coin, so only the net quantity can be moved
+            quantity = base_amount * (1 - buy_fee / 100)
+            quantity = await call_exchange(buy_ex, buy_ops.round_quantity, token, quantity)
+            quantity = await call_exchange(sell_ex, sell_ops.round_quantity, token, quantity)
+            if quantity <= 0:
+                await notify(f"{token} quantity is below the lot size on {buy_ex} or {sell_ex}. Skipping.")
+                return False
+            order_size = base_amount if buy_ops.buys_in_base else amount
+
+        # 1. Buy on buy_exchange
+        await notify(f"Placing buy order for {token} on {buy_ex}...")
+        buy_order = await call_exchange(buy_ex, buy_ops.buy, token, order_size)
+    finally:
+        balance_ledger.release(user_id, buy_ex, 'USDT', reserved)
+    await notify(f"Bought {token} on {buy_ex}: {buy_order}")
+
+    asset = token.split('/')[0]
+    async with deposit_locks.setdefault((user_id, sell_ex, asset), asyncio.Lock()):
+        # 2. Fetch deposit address from sell_exchange
+        await notify(f"Fetching deposit address for {asset} on {sell_ex}...")
+        deposit_address = await call_exchange(sell_ex, sell_ops.get_deposit_address, asset, network)
+        await notify(f"Deposit address: {deposit_address}")
+
+        # 3. Withdraw from buy_exchange to sell_exchange
+        await notify(f"Withdrawing {asset} to {sell_ex}...")
+        # Deposits that arrived before this withdrawal belong to earlier transfers
+        since = int(time.time() * 1000)
+        withdraw = await call_exchange(buy_ex, buy_ops.withdraw, asset, quantity, deposit_address, network)
+        await notify(f"Withdrew {asset} to {sell_ex}: {withdraw}")
+
+        # 4. Wait for deposit (polls for minutes, so it does not hold an exchange slot)
+        await notify(f"Waiting for deposit of {asset} on {sell_ex}...")
+        deposited = await run_blocking(sell_ops.wait_for_deposit, asset, quantity, since)
+        if not deposited:
+            await notify(f"Deposit not detected on {sell_ex} after waiting. Aborting.")
+            return False
+        await notify(f"Deposit confirmed on {sell_ex}.")
+
+        # 5. Sell on sell_exchange
+        await notify(f"Placing sell order for {token} on {sell_ex}...")
+        sell_order = await call_exchange(sell_ex, sell_ops.sell, token, quantity)
+        await notify(f"Sold {token} on {sell_ex}: {sell_order}")
+
+    await notify("Arbitrage completed!")
+    return True
+
+
+def allocate_capital(budget: float, opportunities: list) -> list:
+    """Split budget across opportunities in proportion to expected profit.
+
+    An opportunity's share is capped at its 'max_notional' (available depth) when
+    known; capital freed by capped opportunities is redistributed to the rest.
+    Returns [(opportunity, amount)] with allocations below MIN_TRADE_AMOUNT dropped.
+    """
+    allocations = {}
+    open_idx = [i for i, opp in enumerate(opportunities) if opp['profit'] > 0]
+    remaining = budget
+    while open_idx and remaining > 1e-9:
+        total_profit = sum(opportunities[i]['profit'] for i in open_idx)
+        capped = []
+        for i in open_idx:
+            share = remaining * opportunities[i]['profit'] / total_profit
+            room = opportunities[i].get('max_notional', float('inf')) - allocations.get(i, 0.0)
+            if share >= room:
+                allocations[i] = allocations.get(i, 0.0) + room
+                capped.append(i)
+        if not capped:
+            for i in open_idx:
+                allocations[i] = allocations.get(i, 0.0) + remaining * opportunities[i]['profit'] / total_profit
+            break
+        remaining = budget - sum(allocations.values())
+        open_idx = [i for i in open_idx if i not in capped]
+    return [
+        (opportunities[i], round(amount, 2))
+        for i, amount in sorted(allocations.items())
+        if amount >= MIN_TRADE_AMOUNT
+    ]
+
+
+async def execute_opportunities(user_id, exchange_map, budget: float, opportunities: list, notify,
+                                fees=None) -> int:
+    """Trade several opportunities concurrently within budget. Returns the number of legs completed.
+
+    Each opportunity is first routed with the whole budget against live order books
+    on the user's venues, which gives the USDT its depth can absorb profitably and
+    the routed profit; the budget is allocated on those, then each allocation is
+    routed again and its child legs run in parallel.
+    """
+    venues = set(exchange_map)
+    all_books = await asyncio.gather(*(fetch_order_books(opp['token']) for opp in opportunities))
+    sized, books_by_token = [], {}
+    for opp, order_books in zip(opportunities, all_books):
+        order_books = {ex_id: book for ex_id, book in order_books.items() if ex_id in venues}
+        books_by_token[opp['token']] = order_books
+        legs = route_order(order_books, opp['token'], budget, fees)
+        capacity = sum(leg['amount'] for leg in legs)
+        if legs:
+            profit = sum(leg['profit'] * leg['amount'] for leg in legs) / capacity
+            opp = {**opp, 'max_notional': capacity, 'profit': round(profit, 2)}
+        elif opp['buy_exchange'] in order_books and opp['sell_exchange'] in order_books:
+            # Both books are live and no longer cross: the spread is gone
+            opp = {**opp, 'max_notional': 0.0}
+        sized.append(opp)
+
+    async def run_leg(token, buy_ex, sell_ex, network, amount, base_amount, buy_fee):
+        async def leg_notify(msg):
+            await notify(f"[{token} {buy_ex}→{sell_ex}] {msg}")
+
+        try:
+            return await execute_arbitrage(user_id, exchange_map, token, buy_ex, sell_ex, network, amount,
+                                           leg_notify, allow_partial=True, base_amount=base_amount,
+                                           buy_fee=buy_fee)
+        except Exception as e:
+            logger.error(f"Scheduled arbitrage failed for {token} ({buy_ex}→{sell_ex}): {e}")
+            await leg_notify(f"Error: {e}")
+            return False
+
+    async def run(opp, amount):
+        token, network = opp['token'], opp.get('network', 'TRC20')
+        legs = [leg for leg in route_order(books_by_token[token], token, amount, fees)
+                if leg['amount'] >= MIN_TRADE_AMOUNT]
+        if not legs:
+            legs = [{"buy_exchange": opp['buy_exchange'], "sell_exchange": opp['sell_exchange'], "amount": amount,
+                     "base_amount": None}]
+        elif len(legs) > 1:
+            await notify(f"Routing {token} across {len(legs)} venue pairs:\n" + "\n".join(
+                f"- {leg['amount']} USDT {leg['buy_exchange']}→{leg['sell_exchange']} "
+                f"(avg {leg['buy_price']:.6g}→{leg['sell_price']:.6g})"
+                for leg in legs
+            ))
+        rates = fee_vector(fees or {}, token)
+        results = await asyncio.gather(*(
+            run_leg(token, leg['buy_exchange'], leg['sell_exchange'], network, leg['amount'],
+                    leg['base_amount'], rates[EXCHANGE_INDEX[leg['buy_exchange']]])
+            for leg in legs
+        ))
+        return sum(1 for ok in results if ok)
+
+    allocations = allocate_capital(budget, sized)
+    if not allocations:
+        await notify(f"Nothing to execute: no opportunity can take at least {MIN_TRADE_AMOUNT} USDT.")
+        return 0
+    await notify("Executing:\n" + "\n".join(
+        f"- {opp['token']}: {amount} USDT ({opp['buy_exchange']}→{opp['sell_exchange']}, {opp['profit']}%)"
+        for opp, amount in allocations
+    ))
+    results = await asyncio.gather(*(run(opp, amount) for opp, amount in allocations))
+    return sum(results)
+
+
+async def execute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    opportunities = context.user_data.get("opportunities")
+    if not opportunities:
+        await update.message.reply_text("No opportunities to execute. Run /scan first.")
+        return
+    try:
+        budget = float(context.args[0]) if context.args else 0
+        if budget <= 0:
+            raise ValueError("Usage: /execute <budget in USDT>, e.g. /execute 100")
+        missing = {ex for opp in opportunities for ex in (opp['buy_exchange'], opp['sell_exchange'])
+                   if ex not in user_data.get(user_id, {})}
+        if missing:
+            opportunities = [opp for opp in opportunities
+                             if opp['buy_exchange'] not in missing and opp['sell_exchange'] not in missing]
+            await update.message.reply_text(f"Skipping opportunities on exchanges without API keys: "
+                                            f"{', '.join(sorted(missing))}")
+        logger.info(f"User {user_id} executing {len(opportunities)} opportunities with budget {budget}")
+        # Fees were loaded by this user's /scan; reloading here would go through whichever
+        # user's keys the module-level clients currently hold
+        fees = fee_cache.get(user_id, {}).get("fees")
+        exchange_map = build_exchange_ops(user_id)
+        try:
+            completed = await execute_opportunities(user_id, exchange_map, budget, opportunities,
+                                                    update.message.reply_text, fees)
+        finally:
+            await close_exchange_ops(exchange_map)
+        await update.message.reply_text(f"Completed {completed} arbitrage trade(s).")
+    except ValueError as e:
+        await update.message.reply_text(f"Error: {str(e)}")
+    except Exception as e:
+        logger.error(f"Execution failed for user {user_id}: {e}")
+        await update.message.reply_text(f"Error: {str(e)}")
+
+
+async def ccxt_free_balance(balance_request, asset):
+    balance = await balance_request
+    return float(balance['free'].get(asset) or 0)
+
+
+def floor_to_step(quantity, step) -> float:
+    step = Decimal(str(step))
+    return float(Decimal(str(quantity)) // step * step)
+
+
+async def ccxt_round_quantity(client, token, quantity):
+    await client.load_markets()
+    # ccxt truncates amounts to the market precision
+    return float(client.amount_to_precision(token, quantity))
+
+
+async def ccxt_wait_for_deposit(client, asset, amount, since, timeout):
+    # Polls on the event loop: the async client's requests cannot be awaited from a worker thread
+    for _ in range(timeout // 10):
+        deposits = await client.fetch_deposits(asset, since)
+        for dep in deposits:
+            if float(dep['amount']) >= float(amount) and dep['status'] == 'ok':
+                return True
+        await asyncio.sleep(10)
+    return False
+
+
 # Exchange Operation Classes
+# Methods call the exchange client directly. With async (ccxt) clients they return
+# awaitables, which run_blocking resolves; multi-request steps such as waiting for a
+# deposit go through async helpers (ccxt_wait_for_deposit, ccxt_free_balance).
+# buy() takes a USDT amount, or a base-asset quantity where buys_in_base is set.
+# wait_for_deposit only counts deposits made at or after `since` (epoch ms).
 class ExchangeOps:
+    buys_in_base = False
+
     def buy(self, token, amount):
         raise NotImplementedError
 
+    def round_quantity(self, token, quantity):
+        raise NotImplementedError
+
     def withdraw(self, asset, amount, address, network):
         raise NotImplementedError
 
     def get_deposit_address(self, asset, network):
         raise NotImplementedError
 
-    def wait_for_deposit(self, asset, amount, timeout=600):
+    def wait_for_deposit(self, asset, amount, since=None, timeout=600):
         raise NotImplementedError
 
     def sell(self, token, amount):
         raise NotImplementedError
 
+    def get_balance(self, asset):
+        raise NotImplementedError
+
 
 class BinanceOps(ExchangeOps):
     def __init__(self, client):
@@ -619,9 +1694,15 @@ class BinanceOps(ExchangeOps):
         info = self.client.get_deposit_address(coin=asset, network=network)
         return info['address']
 
-    def wait_for_deposit(self, asset, amount, timeout=600):
+    def round_quantity(self, token, quantity):
+        info = self.client.get_symbol_info(token.replace('/', ''))
+        step = next(f['stepSize'] for f in info['filters'] if f['filterType'] == 'LOT_SIZE')
+        return floor_to_step(quantity, step)
+
+    def wait_for_deposit(self, asset, amount, since=None, timeout=600):
+        params = {"startTime": since} if since else {}
         for _ in range(timeout // 10):
-            history = self.client.get_deposit_history(coin=asset)
+            history = self.client.get_deposit_history(coin=asset, **params)
             for dep in history:
                 if float(dep['amount']) >= float(amount) and dep['status'] == 1:
                     return True
@@ -632,6 +1713,9 @@ class BinanceOps(ExchangeOps):
         symbol = token.replace('/', '')
         return self.client.create_order(symbol=symbol, side='SELL', type='MARKET', quantity=amount)
 
+    def get_balance(self, asset):
+        return float(self.client.get_asset_balance(asset=asset)['free'])
+
 
 class BybitOps(ExchangeOps):
     def __init__(self, client):
@@ -648,9 +1732,14 @@ class BybitOps(ExchangeOps):
         info = self.client.get_deposit_address(coin=asset, chainType=network)
         return info['result']['address']
 
-    def wait_for_deposit(self, asset, amount, timeout=600):
+    def round_quantity(self, token, quantity):
+        response = self.client.get_instruments_info(category="spot", symbol=token.replace('/', ''))
+        return floor_to_step(quantity, response['result']['list'][0]['lotSizeFilter']['basePrecision'])
+
+    def wait_for_deposit(self, asset, amount, since=None, timeout=600):
+        params = {"startTime": since} if since else {}
         for _ in range(timeout // 10):
-            history = self.client.get_deposit_records(coin=asset)
+            history = self.client.get_deposit_records(coin=asset, **params)
             for dep in history['result']['rows']:
                 if float(dep['amount']) >= float(amount) and dep['status'] == 'success':
                     return True
@@ -661,14 +1750,27 @@ class BybitOps(ExchangeOps):
         symbol = token.replace('/', '')
         return self.client.place_order(category="spot", symbol=symbol, side="Sell", orderType="Market", qty=amount)
 
+    def get_balance(self, asset):
+        response = self.client.get_wallet_balance(accountType="UNIFIED", coin=asset)
+        coins = response['result']['list'][0]['coin']
+        if not coins:
+            return 0.0
+        # Free balance: wallet balance minus what open orders have locked
+        return float(coins[0]['walletBalance']) - float(coins[0]['locked'] or 0)
+
 
 class KucoinOps(ExchangeOps):
+    buys_in_base = True
+
     def __init__(self, client):
         self.client = client
 
     def buy(self, token, amount):
         return self.client.create_market_buy_order(token, amount)
 
+    def round_quantity(self, token, quantity):
+        return ccxt_round_quantity(self.client, token, quantity)
+
     def withdraw(self, asset, amount, address, network):
         params = {"network": network}
         return self.client.withdraw(code=asset, amount=amount, address=address, params=params)
@@ -677,26 +1779,28 @@ class KucoinOps(ExchangeOps):
         info = self.client.fetch_deposit_address(asset, params={"network": network})
         return info['address']
 
-    def wait_for_deposit(self, asset, amount, timeout=600):
-        for _ in range(timeout // 10):
-            deposits = self.client.fetch_deposits(asset)
-            for dep in deposits:
-                if float(dep['amount']) >= float(amount) and dep['status'] == 'ok':
-                    return True
-            time.sleep(10)
-        return False
+    def wait_for_deposit(self, asset, amount, since=None, timeout=600):
+        return ccxt_wait_for_deposit(self.client, asset, amount, since, timeout)
 
     def sell(self, token, amount):
         return self.client.create_market_sell_order(token, amount)
 
+    def get_balance(self, asset):
+        return ccxt_free_balance(self.client.fetch_balance(), asset)
+
 
 class KrakenOps(ExchangeOps):
+    buys_in_base = True
+
     def __init__(self, client):
         self.client = client
 
     def buy(self, token, amount):
         return self.client.create_market_buy_order(token, amount)
 
+    def round_quantity(self, token, quantity):
+        return ccxt_round_quantity(self.client, token, quantity)
+
     def withdraw(self, asset, amount, address, network):
         raise NotImplementedError("Kraken withdrawal not implemented.")
 
@@ -704,26 +1808,28 @@ class KrakenOps(ExchangeOps):
         info = self.client.fetch_deposit_address(asset, params={"network": network})
         return info['address']
 
-    def wait_for_deposit(self, asset, amount, timeout=600):
-        for _ in range(timeout // 10):
-            deposits = self.client.fetch_deposits(asset)
-            for dep in deposits:
-                if float(dep['amount']) >= float(amount) and dep['status'] == 'ok':
-                    return True
-            time.sleep(10)
-        return False
+    def wait_for_deposit(self, asset, amount, since=None, timeout=600):
+        return ccxt_wait_for_deposit(self.client, asset, amount, since, timeout)
 
     def sell(self, token, amount):
         return self.client.create_market_sell_order(token, amount)
 
+    def get_balance(self, asset):
+        return ccxt_free_balance(self.client.fetch_balance(), asset)
+
 
 class BingxOps(ExchangeOps):
+    buys_in_base = True
+
     def __init__(self, client):
         self.client = client
 
     def buy(self, token, amount):
         return self.client.create_market_buy_order(token, amount)
 
+    def round_quantity(self, token, quantity):
+        return ccxt_round_quantity(self.client, token, quantity)
+
     def withdraw(self, asset, amount, address, network):
         params = {"network": network}
         return self.client.withdraw(code=asset, amount=amount, address=address, params=params)
@@ -732,26 +1838,28 @@ class BingxOps(ExchangeOps):
         info = self.client.fetch_deposit_address(asset, params={"network": network})
         return info['address']
 
-    def wait_for_deposit(self, asset, amount, timeout=600):
-        for _ in range(timeout // 10):
-            deposits = self.client.fetch_deposits(asset)
-            for dep in deposits:
-                if float(dep['amount']) >= float(amount) and dep['status'] == 'ok':
-                    return True
-            time.sleep(10)
-        return False
+    def wait_for_deposit(self, asset, amount, since=None, timeout=600):
+        return ccxt_wait_for_deposit(self.client, asset, amount, since, timeout)
 
     def sell(self, token, amount):
         return self.client.create_market_sell_order(token, amount)
 
+    def get_balance(self, asset):
+        return ccxt_free_balance(self.client.fetch_balance(), asset)
+
 
 class OkxOps(ExchangeOps):
+    buys_in_base = True
+
     def __init__(self, client):
         self.client = client
 
     def buy(self, token, amount):
         return self.client.create_market_buy_order(token, amount)
 
+    def round_quantity(self, token, quantity):
+        return ccxt_round_quantity(self.client, token, quantity)
+
     def withdraw(self, asset, amount, address, network):
         params = {"chain": f"{asset}-{network}"}
         return self.client.withdraw(code=asset, amount=amount, address=address, params=params)
@@ -761,25 +1869,26 @@ class OkxOps(ExchangeOps):
         info = self.client.fetch_deposit_address(asset, params=params)
         return info['address']
 
-    def wait_for_deposit(self, asset, amount, timeout=600):
-        for _ in range(timeout // 10):
-            deposits = self.client.fetch_deposits(asset)
-            for dep in deposits:
-                if float(dep['amount']) >= float(amount) and dep['status'] == 'ok':
-                    return True
-            time.sleep(10)
-        return False
+    def wait_for_deposit(self, asset, amount, since=None, timeout=600):
+        return ccxt_wait_for_deposit(self.client, asset, amount, since, timeout)
 
     def sell(self, token, amount):
         return self.client.create_market_sell_order(token, amount)
 
+    def get_balance(self, asset):
+        return ccxt_free_balance(self.client.fetch_balance(), asset)
+
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "feed":
+        asyncio.run(run_market_data_feed())
+        return
     application = Application.builder().token(TELEGRAM_TOKEN).build()
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("scan", scan_command))
     application.add_handler(CommandHandler("setkeys", set_keys))
     application.add_handler(CommandHandler("getip", get_ip))
+    application.add_handler(CommandHandler("execute", execute_command, block=False))
     application.add_handler(CallbackQueryHandler(arbitrage_button_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.UpdateType.MESSAGE, handle_keys),
                             group=1)